@@ -1,8 +1,9 @@
-from datetime import (datetime as dt, timedelta, timezone as tz,
+from datetime import (datetime as dt, timezone as tz,
                       MINYEAR, MAXYEAR)
 
 
 YEAR_TO_DAYS = 365.25
+YEAR_TO_MILLIS = YEAR_TO_DAYS * 24 * 60 * 60 * 1000
 MINDATETIME = dt(MINYEAR, 1, 1, tzinfo=tz.utc)
 MAXDATETIME = dt(MAXYEAR, 12, 31, 23, 59, 59, 999999, tzinfo=tz.utc)
 
@@ -15,19 +16,23 @@ def dt_to_millis(dt):
     return int(dt.timestamp() * 1000)
 
 
+MINMILLIS = dt_to_millis(MINDATETIME)
+
+
 def timestamp_from_age(now, age):
     """
-    Takes `datetime` object `now` and a `float` `age` and returns
-    POSIX timestamp of the date and time `age` years ago from `now`.
+    Takes POSIX timestamp `now` in milliseconds and a `float` `age` and returns
+    POSIX timestamp in milliseconds of the moment `age` years before `now`.
+    The result is never earlier than `MINDATETIME`.
     """
-    return dt_to_millis(now - timedelta(age * YEAR_TO_DAYS))
+    timestamp = now - age * YEAR_TO_MILLIS
+    # written so that also NaN results in `MINMILLIS`
+    return int(timestamp) if timestamp > MINMILLIS else MINMILLIS
 
 
 def age_from_timestamp(now, timestamp):
     """
-    Takes `datetime` object `now` and a POSIX `timestamp` in milliseconds
-    and returns the (possibly not integer) number of years from `timestamp`
-    to `now`.
+    Takes POSIX timestamps `now` and `timestamp` in milliseconds and returns
+    the (possibly not integer) number of years from `timestamp` to `now`.
     """
-    dt_from_ts = dt.fromtimestamp(timestamp / 1000, tz.utc)
-    return (now - dt_from_ts) / timedelta(YEAR_TO_DAYS)
+    return (now - timestamp) / YEAR_TO_MILLIS
@@ -1,75 +1,70 @@
 from datetime import datetime as dt, timezone as tz
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from minio import Minio
+import urllib3
 
 from dthelpers import *
-from udt import UserDataTransformer as UDT
+from udt import MAX_DOWNLOAD_WORKERS, FilterSpec, UserDataTransformer as UDT
 
 
-def convert_to_bool(param):
-    """
-    Takes a string parameter `param` and converts it to a boolean value.
-    The `param` must be either 'True' or 'False', else a `ValueError` is raised.
-    """
-    if param not in ('True', 'False'):
-        raise ValueError('Boolean parameter must be "True" or "False"')
-    return param == 'True'
+# values accepted for the boolean filter parameters
+BOOL_VALUES = {'True': True, 'False': False}
 
+# names of the non-negative float filter parameters
+AGE_PARAMS = ('min_age', 'max_age')
 
-def convert_to_nonneg_float(param):
-    """
-    Takes a string parameter `param` and converts it to a non-negative float
-    value. The `param` must be convertible to such value using `float(param)`,
-    else a `ValueError` is raised.
-    """
-    param = float(param)
-    if param < 0:
-        raise ValueError(
-            'Given float is negative, expecting non-negative float')
-    return param
+# marks parameters missing from the query string
+_MISSING = object()
 
 
-def get_params_vals(req_args):
+def parse_request_params(req_args):
     """
-    Constructs a dictionary mapping parameter names from `GET_params`
-    dictionary to values provided for them in `req_args` dictionary,
-    using the defined in `GET_params` converters for each parameter.
+    Constructs a dictionary mapping the names of the filter parameters:
+    `image_exists`, `min_age`, `max_age`, to the values provided for them
+    in `req_args` dictionary, converted to a boolean value and non-negative
+    floats, respectively. Parameters not provided in `req_args` are omitted.
+    The `image_exists` must be either 'True' or 'False', and the ages must be
+    convertible to such value using `float(param)`, else a `ValueError` is raised.
     """
-    return {name: conv(val) for name, conv in GET_params.items()
-            if (val := req_args.get(name)) is not None}
+    params = {}
+
+    param = req_args.get('image_exists', _MISSING)
+    if param is not _MISSING:
+        image_exists = BOOL_VALUES.get(param)
+        if image_exists is None:
+            raise ValueError('Boolean parameter must be "True" or "False"')
+        params['image_exists'] = image_exists
+
+    for name in AGE_PARAMS:
+        param = req_args.get(name, _MISSING)
+        if param is not _MISSING:
+            age = float(param)
+            if age < 0:
+                raise ValueError(
+                    'Given float is negative, expecting non-negative float')
+            params[name] = age
+
+    return params
 
 
 def params_to_filters(params):
     """
-    Constructs filters to be applied to user data. It does that
-    by creating a list of pairs of the format: `('column_name', filter_function)`,
-    where `filter_function` returns a boolean value based on the value from the
-    column named `column_name`. The expected behavior of filtering user data
-    is that a user should be filtered out if any of the filters evaluates to `False`.
+    Constructs filters to be applied to user data, in the form of a `FilterSpec`,
+    whose birth timestamp bounds are computed once from the age parameters.
+    The expected behavior of filtering user data is that a user should be filtered
+    out if they do not meet any of the filters.
     """
-    filters = []
-    now = dt.now(tz.utc)
-
+    now = dt_to_millis(dt.now(tz.utc))
+    max_birthts = min_birthts = None
     if 'min_age' in params:
-        try:
-            max_birthts = timestamp_from_age(now, params['min_age'])
-        except:
-            max_birthts = dt_to_millis(MINDATETIME)
-        filters.append(('birthts', lambda ts: ts <= max_birthts))
-
+        max_birthts = timestamp_from_age(now, params['min_age'])
     if 'max_age' in params:
-        try:
-            min_birthts = timestamp_from_age(now, params['max_age'])
-        except:
-            min_birthts = dt_to_millis(MINDATETIME)
-        filters.append(('birthts', lambda ts: ts >= min_birthts))
+        min_birthts = timestamp_from_age(now, params['max_age'])
 
-    if 'image_exists' in params:
-        filters.append(('img_path', lambda p:
-                        (p != udt.empty_value) == params['image_exists']))
-
-    return filters
+    return FilterSpec(min_birthts=min_birthts,
+                      max_birthts=max_birthts,
+                      image_exists=params.get('image_exists'))
 
 
 app = Flask(__name__)
@@ -94,16 +89,14 @@ def data():
     """
     if request.method == 'GET':
         try:
-            params = get_params_vals(request.args)
+            params = parse_request_params(request.args)
             filters = params_to_filters(params)
 
-            # constructing a JSON response with empty data, then
-            # updating it with the target data
-            resp = jsonify()  
-            resp.set_data(udt.aggr_user_data(filters=filters,
-                                             out_format={'format': 'json',
-                                                         'bin': True}))
-            return resp
+            # the data is already encoded as JSON
+            return Response(udt.aggr_user_data(filters=filters,
+                                               out_format={'format': 'json',
+                                                           'bin': True}),
+                            mimetype='application/json')
         except Exception as e:
             return str(e)
 
@@ -126,7 +119,7 @@ def stats():
     in the database.
     """
     try:
-        params = get_params_vals(request.args)
+        params = parse_request_params(request.args)
         filters = params_to_filters(params)
         return jsonify(udt.avg_user_age(filters=filters))
     except Exception as e:
@@ -136,12 +129,20 @@ def stats():
 if __name__ == '__main__':
     # server setup
 
-    # database client
+    # database client, whose connection pool is large enough to keep
+    # a connection for each of the threads downloading user data
     mc = Minio(
         'minio:9000',
         access_key='admin',
         secret_key='password',
-        secure=False
+        secure=False,
+        http_client=urllib3.PoolManager(
+            maxsize=MAX_DOWNLOAD_WORKERS,
+            timeout=urllib3.Timeout(connect=300, read=300),
+            retries=urllib3.Retry(total=5,
+                                  backoff_factor=0.2,
+                                  status_forcelist=[500, 502, 503, 504])
+        )
     )
 
     bucket_name = 'datalake'
@@ -158,6 +159,9 @@ if __name__ == '__main__':
 
     output_csv_name = 'processed_data/output.csv'
 
+    # directory in which the downloaded user data is persisted between restarts
+    cache_dir = '/var/cache/udt'
+
     # the object which helps the server interface with the database
     # and is able to perform all the needed data transformations
     udt = UDT(
@@ -165,16 +169,8 @@ if __name__ == '__main__':
         bucket_name,
         out_columns=dflt_out_columns,
         src_dir=src_dir,
-        csv_delim=delimiter
+        csv_delim=delimiter,
+        cache_dir=cache_dir
     )
 
-    # a dictionary defining the filter parameters to be extracted
-    # from the `GET` request's query string, and is of the format:
-    # 'param_name': converter
-    GET_params = {
-        'image_exists': convert_to_bool,
-        'min_age': convert_to_nonneg_float,
-        'max_age': convert_to_nonneg_float,
-    }
-
     app.run(host='0.0.0.0', port=8080)
@@ -1,15 +1,251 @@
-from collections import defaultdict as dd
 import concurrent.futures as cf
+import csv
+from dataclasses import dataclass
 from datetime import datetime as dt, timezone as tz
-from io import BytesIO
+from functools import partial
+from io import BytesIO, StringIO
+import os
 from os.path import splitext
+import pickle
+import tempfile
 from threading import Lock
+from typing import Optional
 
+import numpy as np
+import orjson
 import pandas as pd
 
 from dthelpers import *
 
 
+# range of the birth timestamps which can be stored column-wise
+_INT64_INFO = np.iinfo(np.int64)
+
+
+def _to_birthts(value):
+    """
+    Converts `value` to an `int` birth timestamp. Returns `None` if it is not
+    a valid one, or does not fit in the column-wise storage.
+    """
+    try:
+        birthts = int(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    if not _INT64_INFO.min <= birthts <= _INT64_INFO.max:
+        return None
+    return birthts
+
+
+def _make_csv_parser(delimiter):
+    """
+    Returns a function parsing binary data of a single-record CSV, whose fields
+    are delimited by `delimiter`, into a pair of the header and the record's values.
+    The function is specialized for the delimiter, and since all the input CSVs
+    share their header, each distinct header line is parsed only once.
+    The function raises a `ValueError` if the record's length differs from the header's.
+    """
+    # `csv` module accepts only single-character delimiters,
+    # so a multicharactered one is substituted with a single character
+    substitute = None
+    if len(delimiter) == 1:
+        fmt = {'delimiter': delimiter}
+    else:
+        substitute = '\x1f'
+        fmt = {'delimiter': substitute}
+
+    headers = {}  # header lines mapped to the parsed headers
+
+    def parse_csv(bin_data):
+        text = bin_data.decode('utf-8')
+        if substitute is not None:
+            text = text.replace(delimiter, substitute)
+        header_line, _, record = text.partition('\n')
+        header = headers.get(header_line)
+        if header is None:
+            header = headers[header_line] = tuple(next(csv.reader((header_line,), **fmt)))
+        values = next(csv.reader(StringIO(record), **fmt))
+        if len(values) != len(header):
+            raise ValueError(f'Expected {len(header)} fields in the record, got {len(values)}')
+        return header, values
+
+    return parse_csv
+
+
+def _grown(arr, size, fill):
+    """
+    Returns a copy of the 1-D array `arr` extended to the length `size`,
+    with the added elements set to `fill`.
+    """
+    grown = np.full(size, fill, dtype=arr.dtype)
+    grown[:len(arr)] = arr
+    return grown
+
+
+class _MultiCharWriter:
+    """
+    Counterpart of `csv.writer` accepting multicharactered delimiters.
+    Fields containing the delimiter (or just its part without the surrounding
+    whitespace), a quote, or a line break are quoted.
+    """
+
+    def __init__(self, f, delimiter):
+        self._f = f
+        self._delimiter = delimiter
+        # a field containing only the stripped delimiter is quoted as well, as
+        # it would be split by a reader skipping whitespace after delimiters
+        self._stripped = delimiter.strip() or delimiter
+
+    def _field(self, value):
+        value = '' if value is None else str(value)
+        if self._stripped in value or any(c in value for c in '"\r\n'):
+            return '"' + value.replace('"', '""') + '"'
+        return value
+
+    def writerow(self, row):
+        self._f.write(self._delimiter.join(map(self._field, row)) + '\n')
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+
+def _check_columns(out_columns, records):
+    """
+    Raises `KeyError` if `out_columns` contain a name not present in the columns
+    of any of the users' info `records` (image paths are kept separately).
+    Since users' info files may differ in their columns, a user lacking some of
+    `out_columns` is not an error, and their values are missing instead.
+    """
+    missing = set(out_columns) - {'img_path'}
+    for info in records:
+        if not missing:
+            return
+        missing -= info.keys()
+    if records and missing:
+        raise KeyError(
+            'Given output columns contain a name not present in the columns of data')
+
+
+class _ChunkReader:
+    """
+    Read-only file-like object reading bytes from an iterable of
+    byte strings `chunks`, consuming it only as far as needed.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = bytearray()
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buf) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buf += chunk
+        if size < 0:
+            size = len(self._buf)
+        data = bytes(self._buf[:size])
+        del self._buf[:size]
+        return data
+
+
+def _csv_writer(f, delimiter):
+    """
+    Returns an object writing rows delimited by `delimiter` as CSV into
+    the file-like object `f`, through its `writerow` and `writerows` methods.
+    """
+    if len(delimiter) == 1:
+        return csv.writer(f, delimiter=delimiter, lineterminator='\n')
+    return _MultiCharWriter(f, delimiter)
+
+
+def _write_csv(df, delimiter):
+    """
+    Returns UTF-8 encoded CSV, delimited by `delimiter`,
+    with the columns and rows of the `DataFrame` `df`.
+    """
+    buf = StringIO()
+    writer = _csv_writer(buf, delimiter)
+    writer.writerow(df.columns)
+    writer.writerows(df.itertuples(index=False, name=None))
+    return buf.getvalue().encode('utf-8')
+
+
+def _write_json(df):
+    """
+    Returns UTF-8 encoded JSON list of records, mapping column names
+    to values, of the rows of the `DataFrame` `df`.
+    """
+    columns = list(df.columns)
+    records = [dict(zip(columns, row))
+               for row in df.itertuples(index=False, name=None)]
+    return orjson.dumps(records,
+                        option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY)
+
+
+@dataclass(frozen=True)
+class FilterSpec:
+    """
+    Filters to be applied to users' data. A user is filtered out if their
+    "birthts" is less than `min_birthts` or greater than `max_birthts`, or if
+    their image's existence differs from `image_exists`. Fields equal to `None`
+    are not applied.
+    """
+    min_birthts: Optional[int] = None
+    max_birthts: Optional[int] = None
+    image_exists: Optional[bool] = None
+
+
+# filters which do not filter out any user
+NO_FILTERS = FilterSpec()
+
+
+def _apply_filters(mask, birthts, has_birthts, has_img, filters):
+    """
+    Narrows down in place the boolean `mask` of users to those whose birth
+    timestamps `birthts` and image presence flags `has_img` (arrays of length
+    equal to the mask's) satisfy the `FilterSpec` `filters`. Users whose flag
+    in `has_birthts` is not set do not match any bound on the birth timestamp.
+    """
+    if filters.min_birthts is not None or filters.max_birthts is not None:
+        mask &= has_birthts
+    if filters.min_birthts is not None:
+        mask &= birthts >= filters.min_birthts
+    if filters.max_birthts is not None:
+        mask &= birthts <= filters.max_birthts
+    if filters.image_exists is not None:
+        mask &= has_img == filters.image_exists
+
+
+# default maximal number of threads downloading users' data at once. object
+# storage latency is best hidden by many concurrent requests, hence it exceeds
+# the default of `concurrent.futures.ThreadPoolExecutor`
+MAX_DOWNLOAD_WORKERS = 64
+
+# approximate size (in characters) of chunks in which CSVs are generated for upload
+CSV_CHUNK_SIZE = 64 * 1024
+
+# size (in bytes) of parts in which outputs of unknown length are uploaded
+UPLOAD_PART_SIZE = 10 * 1024 * 1024
+
+
+class UserRow:
+    """
+    Cache entry of a single user. `row` is the index of the user's row
+    in the column-wise storage, `last_mod` and `etag` describe the cached
+    version of the user's info file, `future` is the user's latest download
+    job, and `lock` guards the entry's state.
+    """
+    __slots__ = ('row', 'last_mod', 'etag', 'future', 'lock')
+
+    def __init__(self, row):
+        self.row = row
+        self.last_mod = MINDATETIME
+        self.etag = None
+        self.future = None
+        self.lock = Lock()
+
+
 class UserDataTransformer:
     """
     `UserDataTransformer` objects are to be used to interface with
@@ -20,7 +256,8 @@ class UserDataTransformer:
     """
 
     def __init__(self, storage_client, bucket_name, out_columns,
-                 src_dir='', csv_delim=',', empty_value=chr(248), img_exts=None):
+                 src_dir='', csv_delim=',', empty_value=chr(248), img_exts=None,
+                 cache_dir=None, max_workers=MAX_DOWNLOAD_WORKERS):
         """
         `storage_client` Client of the database to draw data from.
 
@@ -39,6 +276,14 @@ class UserDataTransformer:
                          to avoid troubles with parsing the CSV back after exporting.
 
         `img_exts`       A set of extensions of files to be recognized as images.
+
+        `cache_dir`      Directory in which the downloaded users' data is persisted,
+                         so that it survives restarts. If is `None`, the data is cached
+                         only in memory.
+
+        `max_workers`    Maximal number of threads downloading users' data at once
+                         during a single request. The connection pool of the database
+                         client should be able to hold as many connections.
         """
         self.client = storage_client
         self.bucket_name = bucket_name
@@ -46,36 +291,204 @@ class UserDataTransformer:
         self.src_dir = src_dir
         self.csv_delim = csv_delim
         self.empty_value = empty_value
-        self.img_exts = img_exts or {'.png'}
+        self.img_exts = frozenset(img_exts or {'.png'})
+        self.max_workers = max_workers
+
+        # the parser of the input CSVs, and the exporter of the default output
+        # format, are specialized for the delimiter once
+        self._parse_csv = _make_csv_parser(csv_delim)
+        self._export_csv = partial(_write_csv, delimiter=csv_delim)
 
         # since a server which is using this object might handle requests
         # in multiple threads, a couple of them might want to modify the cache
-        # at once. the lock will be used to prevent this, as concurrent modification
-        # could lead to the corruption of locally stored data
-        self._lock = Lock()
-        self._user_cache = dd(lambda: {
-            'info': None,
-            'img_path': self.empty_value,
-            'last_mod': MINDATETIME,
-        })
+        # at once. the cache lock guards the mapping of users and the column-wise
+        # storage, and is held only briefly, while each user's entry has its own
+        # lock guarding the state of the user's download, so that concurrent
+        # requests can share the cache and download users' data in parallel
+        self._cache_lock = Lock()
+        self._user_cache = {}
+
+        # users' data is stored column-wise, every user occupying a single row
+        # of the arrays below, so that the filters can be applied to all users at once
+        self._n_rows = 0
+        self._birthts = np.empty(0, dtype=np.int64)
+        self._has_birthts = np.empty(0, dtype=np.bool_)
+        self._has_info = np.empty(0, dtype=np.bool_)
+        self._has_img = np.empty(0, dtype=np.bool_)
+        self._img_paths = np.empty(0, dtype=object)
+        self._records = np.empty(0, dtype=object)
+
+        # ids of the users whose data is persisted, mapped to the number of writes
+        # to `cache_dir` done up to (and including) the last write of their data
+        self.cache_dir = cache_dir
+        self._persisted = {}
+        self._n_persisted = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._load_cache()
+
+    def _load_cache(self):
+        """
+        Loads into the cache the users' data persisted in `cache_dir`.
+        Files which cannot be read are skipped.
+        """
+        for entry in os.scandir(self.cache_dir):
+            user_id, ext = splitext(entry.name)
+            if ext != '.pkl':
+                continue
+            try:
+                with open(entry.path, 'rb') as f:
+                    saved = pickle.load(f)
+            except Exception:
+                continue
+
+            with self._cache_lock:
+                user = self._get_user(user_id)
+                user.last_mod = saved['last_mod']
+                user.etag = saved['etag']
+                self._set_info(user.row, saved['info'])
+                self._persisted[user_id] = 0
+
+    def _persist_user(self, user_id, info, last_mod, etag):
+        """
+        Atomically writes the user's data to their file in `cache_dir`.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump({'info': info, 'last_mod': last_mod, 'etag': etag}, f)
+            os.replace(tmp_path, os.path.join(self.cache_dir, f'{user_id}.pkl'))
+        except:
+            os.remove(tmp_path)
+            raise
+
+    def _get_user(self, user_id):
+        """
+        Returns the cache entry of the user `user_id`, creating it (and allocating
+        a row of the column-wise storage for the user) if it does not exist.
+        Must be called while holding the cache lock.
+        """
+        user = self._user_cache.get(user_id)
+        if user is None:
+            row = self._n_rows
+            if row == len(self._birthts):
+                size = max(2 * row, 256)
+                self._birthts = _grown(self._birthts, size, 0)
+                self._has_birthts = _grown(self._has_birthts, size, False)
+                self._has_info = _grown(self._has_info, size, False)
+                self._has_img = _grown(self._has_img, size, False)
+                self._img_paths = _grown(self._img_paths, size, self.empty_value)
+                self._records = _grown(self._records, size, None)
+            self._n_rows += 1
+            user = self._user_cache[user_id] = UserRow(row)
+        return user
+
+    def _make_info(self, user_id, fields):
+        """
+        Returns the info dictionary of the user `user_id`, consisting of
+        the `(column, value)` pairs `fields` read from the user's info file.
+        The values are kept as read (empty ones as `None`), only the "birthts"
+        is converted to an `int`, if it is a valid timestamp.
+        """
+        # first column is 'user_id', 'img_path' is kept separately
+        info = {'user_id': user_id}
+        info.update((column, value or None) for column, value in fields)
+        birthts = _to_birthts(info.get('birthts'))
+        if birthts is not None:
+            info['birthts'] = birthts
+        return info
+
+    def _set_info(self, row, info):
+        """
+        Sets the `info` of the user occupying the row `row` (`None` if the info
+        could not be retrieved). A user without a valid "birthts" is kept, but
+        flagged so that they are left out by the filters on the birth timestamp.
+        Must be called while holding the cache lock.
+        """
+        birthts = None if info is None else _to_birthts(info.get('birthts'))
+        has_birthts = birthts is not None
+        if has_birthts:
+            self._birthts[row] = birthts
+        self._records[row] = info
+        self._has_info[row] = info is not None
+        self._has_birthts[row] = has_birthts
+
+    def _store_user(self, user, user_id, o, info):
+        """
+        Stores the `info` of the user `user_id`, whose cache entry is `user`,
+        retrieved from the info file described by the listed object `o`,
+        in the user's row (and in `cache_dir`, if given). `info` is `None`
+        if it could not be retrieved. Must be called while holding the user's lock.
+        """
+        with self._cache_lock:
+            self._set_info(user.row, info)
 
-    def _uid_n_ext(self, path):
+        if info is not None and self.cache_dir is not None:
+            self._persist_user(user_id, info, o.last_modified, o.etag)
+            with self._cache_lock:
+                self._n_persisted += 1
+                self._persisted[user_id] = self._n_persisted
+
+    def _prune_cache(self, user_ids, n_persisted):
         """
-        Given the file path `path`, extracts `user_id` of the user whom
-        the file belongs to, and the extension of the file.
+        Removes from `cache_dir` the persisted data of the users other than
+        `user_ids`, whose info files are no longer present in the database.
+        Only the data persisted within the first `n_persisted` writes is removed,
+        since the data written later might come from files listed by a concurrent
+        request after they were not listed by this one.
         """
-        base, ext = splitext(path)
-        user_id = base[base.rfind('/') + 1:]
-        return user_id, ext
+        with self._cache_lock:
+            removed = [user_id for user_id, n in self._persisted.items()
+                       if n <= n_persisted and user_id not in user_ids]
+            for user_id in removed:
+                del self._persisted[user_id]
+        for user_id in removed:
+            try:
+                os.remove(os.path.join(self.cache_dir, f'{user_id}.pkl'))
+            except FileNotFoundError:
+                pass
 
-    def _read_csv(self, bin_data, delimiter):
+    def _download_user(self, user, user_id, o):
         """
-        Reads binary data `bin_data` of a CSV into a `pandas.DataFrame`,
-        using the given `delimiter`. The delimiter can be multicharactered.
+        Downloads the info file described by the listed object `o` of the user
+        `user_id`, whose cache entry is `user`, and stores the parsed info
+        in the user's row (and in `cache_dir`, if given), unless the entry has been
+        updated to another version of the file in the meantime.
         """
-        return pd.read_csv(BytesIO(bin_data),
-                           delimiter=delimiter,
-                           engine='python')     # enables multicharactered delimiters
+        response = None
+        try:
+            response = self.client.get_object(self.bucket_name, o.object_name)
+            header, values = self._parse_csv(response.data)
+            info = self._make_info(user_id, zip(header, values))
+        except:
+            info = None
+        finally:
+            if response is not None:
+                response.close()
+                response.release_conn()
+
+        with user.lock:
+            # a download of a newer version of the file might have been submitted
+            # in the meantime, in which case the result of this one is dropped
+            if user.etag != o.etag or user.last_mod != o.last_modified:
+                return
+            if info is None:
+                user.last_mod = MINDATETIME
+                user.etag = None
+            self._store_user(user, user_id, o, info)
+
+    def _uid_n_ext(self, path):
+        """
+        Given the file path `path`, extracts `user_id` of the user whom
+        the file belongs to, and the extension of the file.
+        """
+        # searching for the dot only after the last slash, as the path
+        # is prefixed with the (possibly long) source directory
+        start = path.rfind('/') + 1
+        dot = path.rfind('.', start)
+        if dot < 0:
+            return path[start:], ''
+        return path[start:dot], path[dot:]
 
     def export_df(self, df, format='csv', delimiter=',', bin=True):
         """
@@ -84,79 +497,80 @@ class UserDataTransformer:
         If `bool(bin) == True`, the output will be binary, otherwise - a string.
         """
         if format == 'csv':
-            output_data = df.to_csv(index=False)
-            if delimiter != ',':
-                output_data = output_data.replace(',', delimiter)
+            output_bytes = _write_csv(df, delimiter)
         elif format == 'json':
-            output_data = df.to_json(orient='records',
-                                     force_ascii=False,
-                                     indent=2)
+            output_bytes = _write_json(df)
         else:
             raise ValueError(f'Unsupported output data format: {format}')
-        return output_data.encode('utf-8') if bin else output_data
+        return output_bytes if bin else output_bytes.decode('utf-8')
 
-    def aggr_to_df(self, out_columns=None, filters=None, img_exts=None):
+    def _select_rows(self, filters, img_exts, gather):
         """
-        Aggregates users' filtered data, stored currently in the database,
-        into a `DataFrame`.
-
-        `out_columns`   List of columns (their names) that the resulting `DataFrame`
-                        will consist of. If `out_columns` is not given or is `None`,
-                        the result will consist of the default columns given in the
-                        constructor.
-
-        `filters`       List of pairs of the format: `('column', filter_function)`, where
-                        `filter_function` is to be applied to the value in the `column`
-                        in a given user's data. For a given user, if any of the filters
-                        returns a value whose boolean interpretation is `False`, then
-                        information about this user will not be included in the result.
-                        If `filters` is not given or is `None`, then no filter will be
-                        applied.
-
-        `img_exts`      A set of file extensions that will be used to identify image files
-                        by their extension. If `img_exts` is not given or is `None`, images
-                        will be identified based on the `img_exts` passed to the constructor.
+        Updates the cache with users' data stored currently in the database, and
+        returns the result of calling `gather` with an array of indices of rows
+        of the users matching the `FilterSpec` `filters`. `gather` is called
+        while holding the cache lock, so that the rows cannot change meanwhile.
+        `img_exts` is the set of extensions identifying image files.
         """
-        if out_columns is None:
-            out_columns = self.dflt_out_columns
-        if filters is None:
-            filters = []
-        if img_exts is None:
-            img_exts = self.img_exts
-
-        def process_user(user_id):
+        def finish_user(user, user_id, img_path, csv_obj):
             """
-            Updates the `img_path` and checks if the user matches the given filters.
-            Returns user's info contained in a `DataFrame` if the user matches filters,
-            or `None` otherwise.
+            Finishes processing the listed files of the user `user_id`, given by their
+            cache entry: updates the path of their image, and if their info file
+            `csv_obj` was listed, marks them as present and updates their info.
             """
-            user_dict = self._user_cache[user_id]
-            user_info = user_dict['info']
-            if user_info is None:
-                return None
-            user_info.at[0, 'img_path'] = user_dict['img_path']
-
-            try:
-                if all((check(user_info.at[0, column]) for column, check in filters)):
-                    return user_info
+            has_img = img_path != self.empty_value
+            with self._cache_lock:
+                self._img_paths[user.row] = img_path
+                self._has_img[user.row] = has_img
+
+            # users who do not match the image filter are skipped,
+            # without downloading their info
+            if csv_obj is None:
+                return
+            listed.add(user_id)
+            if filters.image_exists is not None and has_img != filters.image_exists:
+                return
+            rows.append(user.row)
+
+            with user.lock:
+                # checking if cached data is outdated, preferably by
+                # comparing ETags, as they change with the contents only
+                if csv_obj.etag is not None:
+                    outdated = user.etag != csv_obj.etag
                 else:
-                    return None
-            except KeyError:
-                raise KeyError(
-                    'One of the filters tried to access a non-existing column')
-            # the other filter-related exceptions are raised normally
+                    outdated = user.last_mod < csv_obj.last_modified
+
+                if outdated:
+                    user.last_mod = csv_obj.last_modified
+                    user.etag = csv_obj.etag
+
+                    # submitting downloading for asynchronous execution
+                    user.future = executor.submit(self._download_user,
+                                                  user,
+                                                  user_id,
+                                                  csv_obj)
+                future = user.future
+
+            # the download might have been submitted by a concurrent request
+            if future is not None and not future.done():
+                futures.append(future)
+
+        # number of writes to `cache_dir` done before the listing
+        with self._cache_lock:
+            n_persisted = self._n_persisted
 
         # using threads to minimize the time spent on downloading data from the database
-        # using a lock to prevent the corruption of data caused by uncontrolled concurrent modification
-        with cf.ThreadPoolExecutor() as executor, self._lock:
-            cached_users = []    # users who can be processed immediately, based on cached data
-            future_to_user = {}  # dictionary mapping asynchronous jobs to users
+        with cf.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            rows = []       # rows of the users present in the database
+            listed = set()  # ids of the users whose info files are in the database
+            futures = []    # asynchronous jobs updating the present users' data
 
             # the below algorithm is described in the README
 
             prev_id = ''
             img_path = self.empty_value
-            user_dict = None
+            csv_obj = None
+            user = None
 
             # as per: https://github.com/minio/minio-py/issues/775
             # I'm assuming that objects will be given sorted lexicographically by names
@@ -167,70 +581,127 @@ class UserDataTransformer:
 
                 if user_id != prev_id:
                     if prev_id:
-                        user_dict['img_path'] = img_path
+                        finish_user(user, prev_id, img_path, csv_obj)
                     prev_id = user_id
                     img_path = self.empty_value
-                    user_dict = self._user_cache[user_id]
+                    csv_obj = None
+                    with self._cache_lock:
+                        user = self._get_user(user_id)
 
                 if ext in img_exts:
                     img_path = o.object_name
                 elif ext == '.csv':
-                    # checking if cached data is outdated
-                    if user_dict['last_mod'] < o.last_modified:
-                        user_dict['last_mod'] = o.last_modified
-
-                        # submitting downloading for asynchronous execution
-                        future = executor.submit(self.client.get_object,
-                                                 self.bucket_name,
-                                                 o.object_name)
-                        future_to_user[future] = user_id
-                    else:
-                        cached_users.append(user_id)
+                    csv_obj = o
 
             if prev_id:
-                user_dict['img_path'] = img_path
-
-            # list of DataFrames of cached users whose info satisfies filters
-            result = [df for user_id in cached_users
-                      if (df := process_user(user_id)) is not None]
-
-            # processing users whose info had to be downloaded
-            for future in cf.as_completed(future_to_user):
-                user_id = future_to_user[future]
-                user_dict = self._user_cache[user_id]
-
-                try:
-                    # .result() reraises the exception if it occured during async execution
-                    response = future.result()
-                    df = self._read_csv(response.data,
-                                        delimiter=self.csv_delim)
-
-                    # first column is 'user_id', and 'img_path' is the last one
-                    df.insert(0, 'user_id', [user_id])
-                    df.insert(len(df.columns),
-                              'img_path',
-                              [self.empty_value])
-                except:
-                    df = None
-                    user_dict['last_mod'] = MINDATETIME
-                finally:
-                    response.close()
-                    response.release_conn()
-
-                user_dict['info'] = df
-                df = process_user(user_id)
-                if df is not None:
-                    result.append(df)
-
-        if result:
-            df = pd.concat(result, ignore_index=True)
-            try:
-                return df[out_columns]
-            except KeyError:
-                raise KeyError(
-                    'Given output columns contain a name not present in the columns of data')
-        else:
-            return pd.DataFrame(columns=out_columns)
+                finish_user(user, prev_id, img_path, csv_obj)
+
+            # waiting for the users whose info had to be downloaded
+            cf.wait(futures)
+
+        if self.cache_dir is not None:
+            self._prune_cache(listed, n_persisted)
+
+        # applying the filters at once to the whole contiguous arrays of the cache,
+        # instead of gathering the present users' rows out of them beforehand
+        with self._cache_lock:
+            n = self._n_rows
+            mask = np.zeros(n, dtype=np.bool_)
+            mask[rows] = True
+            mask &= self._has_info[:n]
+            _apply_filters(mask, self._birthts[:n], self._has_birthts[:n],
+                           self._has_img[:n], filters)
+            return gather(np.flatnonzero(mask))
+
+    def _select(self, filters, img_exts):
+        """
+        Like `_select_rows`, but returns a quadruple: a list of info dictionaries
+        of the users matching the filters, and arrays of those users' birth
+        timestamps, flags telling whether the timestamps are valid, and image paths.
+        """
+        return self._select_rows(filters, img_exts, lambda idx: (
+            self._records[idx].tolist(), self._birthts[idx],
+            self._has_birthts[idx], self._img_paths[idx]))
+
+    def _birthts_after_filters(self, filters, img_exts):
+        """
+        Like `_select_rows`, but returns only the contiguous array of birth
+        timestamps of the users matching the filters, leaving out the users
+        without a valid timestamp.
+        """
+        return self._select_rows(filters, img_exts, lambda idx: (
+            self._birthts[idx[self._has_birthts[idx]]]))
+
+    def _iter_rows(self, out_columns, records, img_paths):
+        """
+        Yields tuples of the values in `out_columns` of the users given by
+        their info `records` and image paths `img_paths`.
+        """
+        _check_columns(out_columns, records)
+        for info, img_path in zip(records, img_paths):
+            yield tuple(img_path if column == 'img_path' else info.get(column)
+                        for column in out_columns)
+
+    def _iter_csv(self, out_columns, delimiter):
+        """
+        Yields the CSV, delimited by `delimiter`, with the `out_columns` of all
+        users' data stored currently in the database, in UTF-8 encoded chunks
+        of about `CSV_CHUNK_SIZE` characters.
+        """
+        records, _, _, img_paths = self._select(NO_FILTERS, self.img_exts)
+        buf = StringIO()
+        writer = _csv_writer(buf, delimiter)
+        writer.writerow(out_columns)
+        for row in self._iter_rows(out_columns, records, img_paths):
+            writer.writerow(row)
+            if buf.tell() >= CSV_CHUNK_SIZE:
+                yield buf.getvalue().encode('utf-8')
+                buf.seek(0)
+                buf.truncate()
+        yield buf.getvalue().encode('utf-8')
+
+    def aggr_to_df(self, out_columns=None, filters=None, img_exts=None):
+        """
+        Aggregates users' filtered data, stored currently in the database,
+        into a `DataFrame`.
+
+        `out_columns`   List of columns (their names) that the resulting `DataFrame`
+                        will consist of. If `out_columns` is not given or is `None`,
+                        the result will consist of the default columns given in the
+                        constructor.
+
+        `filters`       `FilterSpec` describing which users' information will not be
+                        included in the result. If `filters` is not given or is `None`,
+                        then no filter will be applied.
+
+        `img_exts`      A set of file extensions that will be used to identify image files
+                        by their extension. If `img_exts` is not given or is `None`, images
+                        will be identified based on the `img_exts` passed to the constructor.
+        """
+        if out_columns is None:
+            out_columns = self.dflt_out_columns
+        if filters is None:
+            filters = NO_FILTERS
+        if img_exts is None:
+            img_exts = self.img_exts
+
+        records, birthts, has_birthts, img_paths = self._select(filters, img_exts)
+        _check_columns(out_columns, records)
+
+        # the columns are built as whole arrays, the ones kept column-wise
+        # in the cache are taken directly from it (birth timestamps only
+        # if all of them are valid, otherwise they are taken as read)
+        data = {}
+        for column in out_columns:
+            if column == 'img_path':
+                data[column] = img_paths
+            elif column == 'birthts' and has_birthts.all():
+                data[column] = birthts
+            else:
+                data[column] = np.fromiter((info.get(column) for info in records),
+                                           dtype=object,
+                                           count=len(records))
+        return pd.DataFrame(data, columns=out_columns)
 
     def aggr_user_data(self, out_columns=None, filters=None, img_exts=None, out_format=None):
         """
@@ -241,13 +712,9 @@ class UserDataTransformer:
                         If `out_columns` is not given or is `None`, the result will
                         consist of the default columns given in the constructor.
 
-        `filters`       List of pairs of the format: `('column', filter_function)`, where
-                        the `filter_function` is to be applied to the value in the `column`
-                        in a given user's data. For a given user, if any of the filters
-                        returns a value whose boolean interpretation is `False`, then
-                        information about this user will not be included in the result.
-                        If `filters` is not given or is `None`, then no filter will be
-                        applied.
+        `filters`       `FilterSpec` describing which users' information will not be
+                        included in the result. If `filters` is not given or is `None`,
+                        then no filter will be applied.
 
         `img_exts`      A set of file extensions that will be used to identify image files.
                         If `img_exts` is not given or is `None`, images will be identified
@@ -267,38 +734,38 @@ class UserDataTransformer:
                         If is `None`, then the format will be CSV in binary, with fields
                         in rows delimited by the delimiter passed to the constructor.
         """
+        df = self.aggr_to_df(out_columns, filters, img_exts)
         if out_format is None:
-            out_format = {'format': 'csv', 'delimiter': self.csv_delim, 'bin': True}
-
-        return self.export_df(self.aggr_to_df(out_columns, filters, img_exts), **out_format)
+            return self._export_csv(df)
+        return self.export_df(df, **out_format)
 
     def avg_user_age(self, filters=None, img_exts=None):
         """
         Calculates the average age of users matching the given `filters`,
-        whose data is currently stored in the database. In order to calculate the age
-        of a user, a column "birthts", containing a user's UTC birthdate timestamp in
-        milliseconds from POSIX epoch, must exist in the data. If there are no records
-        to calculate the average age from, `-1` is returned.
-
-        `filters`       List of pairs of the format: `('column', filter_function)`, where
-                        the `filter_function` is to be applied to the value in the `column`
-                        in a given user's data. For a given user, if any of the filters
-                        returns a value whose boolean interpretation is `False`, then
-                        information about this user will not be included in the result.
-                        If `filters` is not given or is `None`, then no filter will be
-                        applied.
+        whose data is currently stored in the database. The age of a user is calculated
+        from the column "birthts", containing a user's UTC birthdate timestamp in
+        milliseconds from POSIX epoch. If there are no records to calculate the average
+        age from, `-1` is returned.
+
+        `filters`       `FilterSpec` describing which users' information will not be
+                        included in the result. If `filters` is not given or is `None`,
+                        then no filter will be applied.
 
         `img_exts`      A set of file extensions that will be used to identify image files.
                         If `img_exts` is not given or is `None`, images will be identified
                         based on the `img_exts` set passed to the constructor.
         """
-        try:
-            df = self.aggr_to_df(['birthts'], filters, img_exts)
-        except KeyError:
-            raise KeyError(
-                'User data do not contain the "birthts" column, unable to calculate age')
+        if filters is None:
+            filters = NO_FILTERS
+        if img_exts is None:
+            img_exts = self.img_exts
 
-        return -1 if df.empty else age_from_timestamp(dt.now(tz.utc), df['birthts'].mean())
+        # the mean is reduced directly from the cached timestamps,
+        # without gathering any other users' data
+        birthts = self._birthts_after_filters(filters, img_exts)
+        if birthts.size == 0:
+            return -1
+        return age_from_timestamp(dt_to_millis(dt.now(tz.utc)), birthts.mean())
 
     def update_output(self, output_name, out_format=None):
         """
@@ -320,9 +787,23 @@ class UserDataTransformer:
                         If is `None`, then the format will be CSV in binary, with fields
                         in rows delimited by the delimiter passed to the constructor.
         """
-        output_bytes = self.aggr_user_data(out_format=out_format)
+        if out_format is None:
+            out_format = {'format': 'csv', 'delimiter': self.csv_delim, 'bin': True}
+
+        if out_format.get('format', 'csv') == 'csv':
+            # the CSV is uploaded while it is being generated, in parts of
+            # `UPLOAD_PART_SIZE` bytes, so that it is never stored in memory whole
+            data = _ChunkReader(self._iter_csv(self.dflt_out_columns,
+                                               out_format.get('delimiter', ',')))
+            length = -1
+        else:
+            output_bytes = self.aggr_user_data(out_format=out_format)
+            data = BytesIO(output_bytes)
+            length = len(output_bytes)
+
         return self.client.put_object(self.bucket_name,
                                       output_name,
-                                      data=BytesIO(output_bytes),
-                                      length=len(output_bytes),
+                                      data=data,
+                                      length=length,
+                                      part_size=UPLOAD_PART_SIZE,
                                       content_type='application/csv')